@@ -2,10 +2,24 @@
 import os
 import re
 import json
+import atexit
+import hashlib
+import concurrent.futures
+import pickle
+import queue
+import threading
+import time
+import numpy as np
+import orjson
 import requests
 import gspread
-from flask import Flask, request, jsonify
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import JSONProvider
 from datetime import datetime
+from collections import OrderedDict
+from functools import lru_cache
 from oauth2client.service_account import ServiceAccountCredentials
 import logging
 
@@ -13,7 +27,15 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # Configuration
 WHATSAPP_TOKEN = os.getenv('WHATSAPP_TOKEN')
@@ -21,11 +43,81 @@ VERIFY_TOKEN = os.getenv('VERIFY_TOKEN', 'whatsapp_verify_123')
 HUGGINGFACE_TOKEN = os.getenv('HUGGINGFACE_TOKEN')
 BUSINESS_NAME = os.getenv('BUSINESS_NAME', 'Your Business')
 SUPPORT_EMAIL = os.getenv('SUPPORT_EMAIL', 'support@yourbusiness.com')
+SEMANTIC_CACHE_DIR = os.getenv('SEMANTIC_CACHE_DIR', 'cache')
+SEMANTIC_CACHE_SIZE = int(os.getenv('SEMANTIC_CACHE_SIZE', '10000'))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.9'))
+SHEETS_FLUSH_INTERVAL = float(os.getenv('SHEETS_FLUSH_INTERVAL', '2'))
+SHEETS_BATCH_SIZE = int(os.getenv('SHEETS_BATCH_SIZE', '50'))
+SHEETS_MAX_ATTEMPTS = int(os.getenv('SHEETS_MAX_ATTEMPTS', '5'))
+SHEETS_MAX_RETRY_RECORDS = int(os.getenv('SHEETS_MAX_RETRY_RECORDS', '1000'))
+WHATSAPP_TIMEOUT = float(os.getenv('WHATSAPP_TIMEOUT', '10'))
+HUGGINGFACE_TIMEOUT = float(os.getenv('HUGGINGFACE_TIMEOUT', '60'))
+MAX_PENDING_TASKS = int(os.getenv('MAX_PENDING_TASKS', '256'))
+
+# First row number of an A1 range such as 'A12:G14'
+_RANGE_ROW_RE = re.compile(r'[A-Z]+(\d+)')
+
+# Compiled once instead of on every inbound message; one pass finds every field.
+# Phone and order matches may not run into an email's local part, so an address
+# like +4412345678@x.com is still found whole by the email group.
+_NOT_EMAIL_PREFIX = r'(?![A-Za-z0-9._%+-]*@)'
+_EXTRACTORS = re.compile(
+    r'(?P<email>\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b)'
+    r'|(?P<phone>\+?\d[\d -]{8,}\d' + _NOT_EMAIL_PREFIX + r')'
+    r'|(?P<order>#\d{4,}' + _NOT_EMAIL_PREFIX + r')'
+)
+
+def create_session(token, retry_statuses, retry_reads):
+    # Pooled keep-alive connections avoid a TLS handshake per outbound call
+    retries = Retry(
+        total=3,
+        read=3 if retry_reads else 0,
+        backoff_factor=0.3,
+        status_forcelist=retry_statuses,
+        allowed_methods=frozenset(['GET', 'POST']),
+        raise_on_status=False
+    )
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=20, pool_maxsize=50, max_retries=retries))
+    session.headers.update({
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json"
+    })
+    return session
+
+# A 5xx or dropped read can arrive after Meta accepted the message, so sends are
+# only retried when they were rejected outright; inference calls are safe to repeat
+_WA_SESSION = create_session(WHATSAPP_TOKEN, retry_statuses=[429], retry_reads=False)
+_HF_SESSION = create_session(HUGGINGFACE_TOKEN, retry_statuses=[429, 500, 502, 503, 504], retry_reads=True)
+
+# (epoch second, date string, time string) for the last formatted second
+_now_cache = (0, '', '')
+
+def _now_strs():
+    global _now_cache
+    cached = _now_cache
+    timestamp = time.time()
+    second = int(timestamp)
+    if second != cached[0]:
+        # Reuse the same clock reading so the strings match the cached second
+        now = datetime.fromtimestamp(timestamp)
+        cached = (second, now.strftime('%Y-%m-%d'), now.strftime('%H:%M:%S'))
+        _now_cache = cached
+    return cached[1], cached[2]
 
 class GoogleSheetsManager:
     def __init__(self):
         self.sheet = None
+        self.row_index = {}  # phone number -> (sheet row, total interactions)
+        self.write_queue = queue.Queue()
+        self.retry_records = []  # (record, failed attempts), guarded by flush_lock
+        self.flush_event = threading.Event()
+        self.flush_lock = threading.Lock()
         self.setup_google_sheets()
+        
+        if self.sheet and self.load_row_index():
+            threading.Thread(target=self.flush_loop, daemon=True).start()
+            atexit.register(self.flush)
     
     def setup_google_sheets(self):
         try:
@@ -71,87 +163,284 @@ class GoogleSheetsManager:
         except Exception as e:
             logger.error(f"Error ensuring headers: {e}")
     
-    def store_customer_data(self, name, phone, email, question):
+    def load_row_index(self):
+        # Without the index every returning customer would be appended again,
+        # so writes are disabled if the sheet can't be read
+        for attempt in range(3):
+            try:
+                self.row_index.clear()
+                rows = self.sheet.get_all_values()
+                for row_num, row in enumerate(rows[1:], start=2):
+                    if len(row) > 1 and row[1]:
+                        # Hand-edited counts that aren't plain numbers restart at zero
+                        interactions = int(row[6]) if len(row) > 6 and row[6].isdigit() else 0
+                        self.row_index.setdefault(row[1], (row_num, interactions))
+                return True
+            except Exception as e:
+                logger.error(f"Error loading customer rows (attempt {attempt + 1}): {e}")
+                if attempt < 2:
+                    time.sleep(2 ** attempt)
+        
+        logger.error("Customer rows unavailable; customer data will not be stored")
+        self.sheet = None
+        return False
+    
+    def batch_store(self, records):
         try:
             if not self.sheet:
                 return False
             
-            current_date = datetime.now().strftime('%Y-%m-%d')
-            current_time = datetime.now().strftime('%H:%M:%S')
+            current_date, current_time = _now_strs()
             
-            # Find existing customer
-            try:
-                phone_cells = self.sheet.findall(phone)
-                if phone_cells:
-                    row_num = phone_cells[0].row
-                    current_interactions = self.sheet.cell(row_num, 7).value or '0'
-                    new_interactions = str(int(current_interactions) + 1)
-                    
-                    self.sheet.update(f'A{row_num}:G{row_num}', [[
-                        name, phone, email, question, current_date, 
-                        current_time, new_interactions
-                    ]])
-                else:
-                    self.sheet.append_row([
-                        name, phone, email, question, current_date, 
-                        current_time, '1'
-                    ])
-                
-                return True
-            except:
-                self.sheet.append_row([
-                    name, phone, email, question, current_date, 
-                    current_time, '1'
-                ])
-                return True
+            # Written to the sheet in batches by flush_loop
+            for name, phone, email, question in records:
+                self.write_queue.put([name, phone, email, question, current_date, current_time])
+            if self.write_queue.qsize() >= SHEETS_BATCH_SIZE:
+                self.flush_event.set()
+            return True
                 
         except Exception as e:
             logger.error(f"Error storing customer data: {e}")
             return False
-
-class AIResponseGenerator:
-    def __init__(self):
-        self.huggingface_url = "https://api-inference.huggingface.co/models/microsoft/DialoGPT-large"
-        self.headers = {"Authorization": f"Bearer {HUGGINGFACE_TOKEN}"}
     
-    def get_ai_response(self, message, customer_name):
-        try:
-            # Check for common queries
-            predefined_response = self.get_predefined_response(message.lower())
-            if predefined_response:
-                return predefined_response.format(name=customer_name, business=BUSINESS_NAME)
-            
-            # Generate AI response
-            prompt = f"Customer {customer_name} says: {message}. Reply as helpful customer support:"
-
-            payload = {
-                "inputs": prompt,
-                "parameters": {
-                    "max_length": 150,
-                    "temperature": 0.7
-                },
-                "options": {"wait_for_model": True}
-            }
+    def flush_loop(self):
+        while True:
+            self.flush_event.wait(SHEETS_FLUSH_INTERVAL)
+            self.flush_event.clear()
+            self.flush()
+    
+    def flush(self):
+        with self.flush_lock:
+            # flush is the only consumer, so the queue can't drain under us
+            pending = self.retry_records
+            while not self.write_queue.empty():
+                pending.append((self.write_queue.get_nowait(), 0))
+            if not pending:
+                return
             
-            response = requests.post(self.huggingface_url, headers=self.headers, json=payload)
+            failed = {id(record) for record in self.write_records([record for record, _ in pending])}
+            retry_records = []
+            for record, attempts in pending:
+                if id(record) not in failed:
+                    continue
+                if attempts + 1 >= SHEETS_MAX_ATTEMPTS:
+                    logger.error(f"Dropping customer data for {record[1]} after {attempts + 1} failed writes")
+                else:
+                    retry_records.append((record, attempts + 1))
             
-            if response.status_code == 200:
-                result = response.json()
-                if isinstance(result, list) and len(result) > 0:
-                    generated_text = result[0].get('generated_text', '')
-                    ai_response = generated_text.replace(prompt, '').strip()
-                    
-                    if ai_response and len(ai_response) > 10:
-                        return ai_response[:400]
-                    
-            return f"Hello {customer_name}! Thank you for contacting {BUSINESS_NAME}. How can I help you today?"
+            # Keep a long outage from growing the backlog without bound
+            overflow = len(retry_records) - SHEETS_MAX_RETRY_RECORDS
+            if overflow > 0:
+                logger.error(f"Dropping {overflow} queued customer records, retry backlog full")
+                retry_records = retry_records[overflow:]
+            self.retry_records = retry_records
+    
+    def write_records(self, records):
+        # Returns the records that weren't written so flush can retry them
+        
+        # Collapse repeat messages from one customer into a single row write
+        latest = {}
+        counts = {}
+        for record in records:
+            phone = record[1]
+            latest[phone] = record
+            counts[phone] = counts.get(phone, 0) + 1
+        
+        updated, updates = [], []
+        appended, new_rows = [], []
+        for phone, record in latest.items():
+            if phone in self.row_index:
+                row_num, interactions = self.row_index[phone]
+                updated.append(phone)
+                updates.append({
+                    'range': f'A{row_num}:G{row_num}',
+                    'values': [record + [str(interactions + counts[phone])]]
+                })
+            else:
+                appended.append(phone)
+                new_rows.append(record + [str(counts[phone])])
+        
+        failed = set()
+        if updates:
+            written = updated
+            try:
+                self.sheet.batch_update(updates)
+            except Exception as e:
+                logger.error(f"Error updating customer data: {e}")
+                # batch_update is all-or-nothing, so retry row by row to keep one
+                # bad range (e.g. a row deleted by hand) from blocking the rest
+                written = []
+                if len(updates) > 1:
+                    for phone, update in zip(updated, updates):
+                        try:
+                            self.sheet.update(update['range'], update['values'])
+                            written.append(phone)
+                        except Exception as e:
+                            logger.error(f"Error updating customer data for {phone}: {e}")
+                failed.update(set(updated).difference(written))
             
+            for phone in written:
+                row_num, interactions = self.row_index[phone]
+                self.row_index[phone] = (row_num, interactions + counts[phone])
+        
+        if new_rows:
+            try:
+                result = self.sheet.append_rows(new_rows, value_input_option='RAW')
+                # Sheets appends after the table it detects, which need not be the
+                # last row we know about, so take the row numbers from the response
+                first_row = int(_RANGE_ROW_RE.match(
+                    result['updates']['updatedRange'].rsplit('!', 1)[-1]).group(1))
+                for row_num, phone in enumerate(appended, start=first_row):
+                    self.row_index[phone] = (row_num, counts[phone])
+            except Exception as e:
+                logger.error(f"Error appending customer data: {e}")
+                failed.update(appended)
+        
+        return [record for record in records if record[1] in failed]
+
+class SemanticCache:
+    def __init__(self, directory, threshold, maxsize):
+        self.directory = directory
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.embeddings = None  # (N, dim) float32 matrix of unit-length rows
+        self.responses = []
+        self.keys = []  # row -> entry key
+        self.entries = OrderedDict()  # entry key -> row, least recently used first
+        self.lock = threading.Lock()
+        self.load()
+    
+    @staticmethod
+    def make_key(message):
+        return hashlib.sha256(message.encode()).hexdigest()
+    
+    def entry_path(self, key):
+        return os.path.join(self.directory, key[:2], f'{key}.pkl')
+    
+    def load(self):
+        paths = []
+        for root, _, files in os.walk(self.directory):
+            paths.extend(os.path.join(root, name) for name in files if name.endswith('.pkl'))
+        
+        # Newest first, so the most recently written entries survive the size cap
+        paths.sort(key=os.path.getmtime, reverse=True)
+        loaded = []
+        for i, path in enumerate(paths):
+            if len(loaded) >= self.maxsize:
+                # Older entries beyond the cap would only be evicted again
+                for stale in paths[i:] if self.maxsize > 0 else ():
+                    try:
+                        os.remove(stale)
+                    except OSError as e:
+                        logger.error(f"Error removing semantic cache entry {stale}: {e}")
+                break
+            try:
+                with open(path, 'rb') as f:
+                    embedding, response = pickle.load(f)
+                loaded.append((os.path.basename(path)[:-4], embedding, response))
+            except Exception as e:
+                logger.error(f"Error loading semantic cache entry {path}: {e}")
+        
+        # Built in one go; growing the matrix row by row made startup quadratic
+        if loaded:
+            loaded.reverse()
+            self.embeddings = np.stack([embedding for _, embedding, _ in loaded]).astype(np.float32, copy=False)
+            self.responses = [response for _, _, response in loaded]
+            self.keys = [key for key, _, _ in loaded]
+            self.entries = OrderedDict((key, row) for row, key in enumerate(self.keys))
+        
+        if self.entries:
+            logger.info(f"Loaded {len(self.entries)} cached responses")
+    
+    def persist(self, key, embedding, response, evicted):
+        try:
+            path = self.entry_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                pickle.dump((embedding, response), f)
+            if evicted:
+                os.remove(self.entry_path(evicted))
         except Exception as e:
-            logger.error(f"AI response error: {e}")
-            return f"Hi {customer_name}! Thanks for your message. Our team will get back to you soon!"
+            logger.error(f"Error saving semantic cache entry: {e}")
     
-    def get_predefined_response(self, message):
-        responses = {
+    def get(self, message):
+        key = self.make_key(message)
+        with self.lock:
+            row = self.entries.get(key)
+            if row is None:
+                return None
+            self.entries.move_to_end(key)
+            return key, self.responses[row]
+    
+    def touch(self, key):
+        # Keeps entries served from the response memo at the fresh end of the LRU
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+    
+    def lookup(self, embedding):
+        with self.lock:
+            if self.embeddings is None:
+                return None
+            # Rows and query are normalised, so one matmul scores every entry
+            # Kept as float32: NumPy has no BLAS kernel for int8 matmul, so an int8
+            # matrix would be upcast on every query and score slower than this
+            scores = self.embeddings @ embedding
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                key = self.keys[best]
+                self.entries.move_to_end(key)
+                return key, self.responses[best]
+            return None
+    
+    def add(self, message, embedding, response):
+        key = self.make_key(message)
+        # File writes stay under the lock so a concurrent re-add of an evicted
+        # key can't have its file removed
+        with self.lock:
+            evicted = self.store(key, embedding, response)
+            if key in self.entries:
+                self.persist(key, embedding, response, evicted)
+    
+    def store(self, key, embedding, response):
+        # Returns the key of the entry evicted to make room, if any
+        evicted = None
+        if self.maxsize <= 0:
+            return None
+        elif key in self.entries:
+            row = self.entries[key]
+            self.entries.move_to_end(key)
+        elif len(self.entries) >= self.maxsize:
+            # Reuse the least recently used row in place
+            evicted, row = self.entries.popitem(last=False)
+            self.keys[row] = key
+            self.entries[key] = row
+        else:
+            if self.embeddings is None:
+                self.embeddings = embedding[np.newaxis, :]
+            else:
+                self.embeddings = np.vstack([self.embeddings, embedding])
+            self.responses.append(response)
+            self.keys.append(key)
+            self.entries[key] = len(self.keys) - 1
+            return None
+        
+        self.embeddings[row] = embedding
+        self.responses[row] = response
+        return evicted
+
+# The model answered, but with nothing worth sending
+class NoUsableResponse(Exception):
+    pass
+
+class AIResponseGenerator:
+    DEFAULT_RESPONSE = "Hello {name}! Thank you for contacting {business}. How can I help you today?"
+    
+    def __init__(self):
+        self.huggingface_url = "https://api-inference.huggingface.co/models/microsoft/DialoGPT-large"
+        self.embedding_url = "https://api-inference.huggingface.co/pipeline/feature-extraction/sentence-transformers/all-MiniLM-L6-v2"
+        self.cache = SemanticCache(SEMANTIC_CACHE_DIR, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_SIZE)
+        self.predefined_responses = {
             'hello': "Hello {name}! Welcome to {business}. How can I help you today?",
             'hi': "Hi {name}! Thanks for contacting {business}. What can I assist you with?",
             'help': "I'm here to help! Please tell me what you need assistance with.",
@@ -160,29 +449,195 @@ class AIResponseGenerator:
             'order': "I'd be happy to help with your order. Could you provide your order number?",
             'support': f"You're talking to our support! For complex issues, email {SUPPORT_EMAIL}.",
         }
+        # One alternation scans the message once for every keyword
+        self.keyword_pattern = re.compile('|'.join(map(re.escape, self.predefined_responses)))
+        self._compute_response = lru_cache(maxsize=4096)(self._compute_response)
+    
+    def get_embedding(self, text):
+        return self.get_embeddings([text])[0]
+    
+    def get_embeddings(self, texts):
+        try:
+            payload = {"inputs": texts, "options": {"wait_for_model": True}}
+            response = _HF_SESSION.post(self.embedding_url, json=payload, timeout=HUGGINGFACE_TIMEOUT)
+            
+            if response.status_code == 200:
+                embeddings = np.asarray(response.json(), dtype=np.float32)
+                if embeddings.ndim == 2 and len(embeddings) == len(texts):
+                    norms = np.linalg.norm(embeddings, axis=1)
+                    return [embedding / norm if norm > 0 else None
+                            for embedding, norm in zip(embeddings, norms)]
+            return [None] * len(texts)
+            
+        except Exception as e:
+            logger.error(f"Embedding error: {e}")
+            return [None] * len(texts)
+    
+    def get_ai_response(self, message, customer_name, resolved=None):
+        try:
+            message_lower = message.lower()
+            response_template = resolved.get(message_lower) if resolved else None
+            if response_template is None:
+                response_template, cache_key = self._compute_response(message_lower)
+                # Memo hits never reach the semantic cache, so refresh its LRU here
+                if cache_key:
+                    self.cache.touch(cache_key)
+            return response_template.format(name=customer_name, business=BUSINESS_NAME)
+            
+        except NoUsableResponse:
+            return self.DEFAULT_RESPONSE.format(name=customer_name, business=BUSINESS_NAME)
+        except Exception as e:
+            logger.error(f"AI response error: {e}")
+            return f"Hi {customer_name}! Thanks for your message. Our team will get back to you soon!"
+    
+    def get_ai_responses(self, items):
+        # Resolve the batch's cache misses with one embedding call and one
+        # generation call, then answer each message through the usual path
+        resolved = self.prefetch(list(dict.fromkeys(message.lower() for message, _ in items)))
+        return [self.get_ai_response(message, customer_name, resolved)
+                for message, customer_name in items]
+    
+    def prefetch(self, messages):
+        # Returns templates for this batch only; semantic hits are not re-cached
+        # under each near-duplicate message
+        resolved = {}
+        if not HUGGINGFACE_TOKEN:
+            return resolved
+        
+        pending = [message for message in messages
+                   if not self.get_predefined_response(message) and self.cache.get(message) is None]
+        if len(pending) < 2:
+            return resolved
+        
+        try:
+            misses = []
+            for message, embedding in zip(pending, self.get_embeddings(pending)):
+                if embedding is None:
+                    continue
+                cached = self.cache.lookup(embedding)
+                if cached:
+                    resolved[message] = self.escape_template(cached[1])
+                else:
+                    misses.append((message, embedding))
+            
+            if misses:
+                ai_responses = self.generate_responses([message for message, _ in misses])
+                for (message, embedding), ai_response in zip(misses, ai_responses):
+                    if ai_response:
+                        self.cache.add(message, embedding, ai_response)
+                        resolved[message] = self.escape_template(ai_response)
+                        
+        except Exception as e:
+            logger.error(f"AI prefetch error: {e}")
+        
+        return resolved
+    
+    def _compute_response(self, message_lower):
+        # Returns an unformatted template so identical messages from different
+        # customers share one cache entry, plus the semantic cache key that
+        # backs it (if any); failures raise and are not cached.
+        
+        # Check for common queries
+        predefined_response = self.get_predefined_response(message_lower)
+        if predefined_response:
+            return predefined_response, None
+        
+        # Without a token every Hugging Face call would just come back 401
+        if not HUGGINGFACE_TOKEN:
+            return self.DEFAULT_RESPONSE, None
+        
+        # Exact repeats skip the embedding call
+        cached = self.cache.get(message_lower)
+        if cached:
+            return self.escape_template(cached[1]), cached[0]
+        
+        # Reuse the reply to a semantically similar earlier message
+        embedding = self.get_embedding(message_lower)
+        if embedding is not None:
+            cached = self.cache.lookup(embedding)
+            if cached:
+                return self.escape_template(cached[1]), cached[0]
         
-        for keyword, response in responses.items():
-            if keyword in message:
-                return response
-        return None
+        # Generate AI response
+        ai_response = self.generate_responses([message_lower])[0]
+        if ai_response:
+            cache_key = None
+            if embedding is not None:
+                self.cache.add(message_lower, embedding, ai_response)
+                cache_key = self.cache.make_key(message_lower)
+            return self.escape_template(ai_response), cache_key
+        
+        # Raised rather than returned so an empty or too-short reply isn't memoised
+        raise NoUsableResponse()
+    
+    def generate_responses(self, messages):
+        # One generation call for every message; None where the reply is unusable
+        prompts = [f"Customer says: {message}. Reply as helpful customer support:" for message in messages]
+
+        payload = {
+            "inputs": prompts,
+            "parameters": {
+                "max_length": 150,
+                "temperature": 0.7
+            },
+            "options": {"wait_for_model": True}
+        }
+        
+        response = _HF_SESSION.post(self.huggingface_url, json=payload, timeout=HUGGINGFACE_TIMEOUT)
+        response.raise_for_status()
+        
+        result = response.json()
+        ai_responses = [None] * len(prompts)
+        if not isinstance(result, list):
+            return ai_responses
+        
+        for i, (prompt, generated) in enumerate(zip(prompts, result)):
+            # Batched inputs come back as a list of candidates per prompt
+            if isinstance(generated, list):
+                generated = generated[0] if generated else {}
+            generated_text = generated.get('generated_text', '')
+            
+            # The model echoes the prompt first, so slice it off without scanning
+            if generated_text.startswith(prompt):
+                ai_response = generated_text[len(prompt):].strip()
+            else:
+                ai_response = generated_text.replace(prompt, '').strip()
+            
+            if ai_response and len(ai_response) > 10:
+                ai_responses[i] = ai_response[:400]
+                
+        return ai_responses
+    
+    @staticmethod
+    def escape_template(text):
+        return text.replace('{', '{{').replace('}', '}}')
+    
+    def get_predefined_response(self, message):
+        match = self.keyword_pattern.search(message)
+        return self.predefined_responses[match.group(0)] if match else None
 
 # Initialize managers
 sheets_manager = GoogleSheetsManager()
 ai_generator = AIResponseGenerator()
 
+# Runs Sheets and AI work off the request thread so Meta gets a fast 200
+_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=16)
+# Caps queued plus running tasks so a slow backend can't grow the backlog forever
+_PENDING_TASKS = threading.BoundedSemaphore(MAX_PENDING_TASKS)
+
+def extract_details(text):
+    # First email, phone number and order reference in the message
+    details = {}
+    for match in _EXTRACTORS.finditer(text):
+        details.setdefault(match.lastgroup, match.group())
+    return details
+
 def extract_email(text):
-    email_pattern = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
-    match = re.search(email_pattern, text)
-    return match.group(0) if match else 'Not provided'
+    return extract_details(text).get('email', 'Not provided')
 
 def send_whatsapp_message(phone_number_id, to_number, message):
     try:
         url = f"https://graph.facebook.com/v18.0/{phone_number_id}/messages"
-        headers = {
-            "Authorization": f"Bearer {WHATSAPP_TOKEN}",
-            "Content-Type": "application/json"
-        }
-        
         payload = {
             "messaging_product": "whatsapp",
             "to": to_number,
@@ -190,13 +645,72 @@ def send_whatsapp_message(phone_number_id, to_number, message):
             "text": {"body": message}
         }
         
-        response = requests.post(url, headers=headers, json=payload)
+        # Content-Type is already set on the session
+        response = _WA_SESSION.post(url, data=orjson.dumps(payload), timeout=WHATSAPP_TIMEOUT)
         return response.status_code == 200
         
     except Exception as e:
         logger.error(f"Error sending WhatsApp message: {e}")
         return False
 
+def extract_text_messages(data):
+    messages = []
+    if data.get('object') != 'whatsapp_business_account':
+        return messages
+    
+    # Meta may deliver several messages, changes or entries in one payload
+    for entry in data.get('entry', ()):
+        for change in entry.get('changes', ()):
+            # Status receipts carry 'statuses' rather than 'messages', and media
+            # is dropped here too, before any contact or metadata parsing
+            try:
+                value = change['value']
+                text_messages = [message_data for message_data in value['messages']
+                                 if message_data.get('type') == 'text']
+            except (KeyError, TypeError):
+                continue
+            if not text_messages:
+                continue
+            
+            phone_number_id = value['metadata']['phone_number_id']
+            contacts = value.get('contacts', ())
+            profiles = {contact.get('wa_id'): contact.get('profile', {}) for contact in contacts}
+            default_profile = contacts[0].get('profile', {}) if contacts else None
+            
+            for message_data in text_messages:
+                # Extract information
+                from_number = message_data.get('from')
+                message_text = message_data.get('text', {}).get('body', '')
+                
+                customer_name = 'Customer'
+                profile = profiles.get(from_number, default_profile)
+                if profile is not None:
+                    customer_name = profile.get('name', from_number)
+                
+                messages.append((phone_number_id, from_number, customer_name, message_text))
+    
+    return messages
+
+def _process_messages(messages):
+    try:
+        # Extract emails and store data
+        sheets_manager.batch_store([
+            (customer_name, from_number, extract_email(message_text), message_text)
+            for _, from_number, customer_name, message_text in messages
+        ])
+        
+        # Generate and send AI responses
+        ai_responses = ai_generator.get_ai_responses([
+            (message_text, customer_name) for _, _, customer_name, message_text in messages
+        ])
+        for (phone_number_id, from_number, _, _), ai_response in zip(messages, ai_responses):
+            send_whatsapp_message(phone_number_id, from_number, ai_response)
+        
+    except Exception as e:
+        logger.error(f"Error processing messages: {e}")
+    finally:
+        _PENDING_TASKS.release()
+
 @app.route('/webhook', methods=['GET'])
 def verify_webhook():
     try:
@@ -217,74 +731,56 @@ def verify_webhook():
 @app.route('/webhook', methods=['POST'])
 def handle_message():
     try:
-        data = request.get_json()
+        data = orjson.loads(request.get_data())
         
-        if (data.get('object') == 'whatsapp_business_account' and 
-            data.get('entry') and 
-            data['entry'][0].get('changes') and
-            data['entry'][0]['changes'][0].get('value', {}).get('messages')):
-            
-            entry = data['entry'][0]
-            changes = entry['changes'][0]
-            value = changes['value']
-            
-            message_data = value['messages'][0]
-            contacts = value.get('contacts', [])
-            phone_number_id = value['metadata']['phone_number_id']
-            
-            # Extract information
-            from_number = message_data.get('from')
-            message_text = message_data.get('text', {}).get('body', '')
-            
-            customer_name = 'Customer'
-            if contacts:
-                profile = contacts[0].get('profile', {})
-                customer_name = profile.get('name', from_number)
-            
-            # Only process text messages
-            if message_data.get('type') != 'text':
-                return jsonify({'status': 'ignored'}), 200
-            
+        messages = extract_text_messages(data)
+        if not messages:
+            return jsonify({'status': 'ignored'}), 200
+        
+        for _, _, customer_name, message_text in messages:
             logger.info(f"Message from {customer_name}: {message_text}")
-            
-            # Extract email and store data
-            email = extract_email(message_text)
-            sheets_manager.store_customer_data(customer_name, from_number, email, message_text)
-            
-            # Generate and send AI response
-            ai_response = ai_generator.get_ai_response(message_text, customer_name)
-            send_whatsapp_message(phone_number_id, from_number, ai_response)
-            
-            return jsonify({'status': 'success'}), 200
+        
+        # When the backlog is full, let Meta redeliver the payload later
+        if not _PENDING_TASKS.acquire(blocking=False):
+            logger.error("Message backlog full, deferring payload")
+            return jsonify({'status': 'busy'}), 503
+        
+        _EXECUTOR.submit(_process_messages, messages)
+        
+        return jsonify({'status': 'queued'}), 200
             
     except Exception as e:
         logger.error(f"Error handling message: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+# Probe endpoints are hit constantly, so their static parts are built once
+_HEALTH_SERVICES = {
+    'whatsapp_token': bool(WHATSAPP_TOKEN),
+    'huggingface_token': bool(HUGGINGFACE_TOKEN),
+    'google_sheets': sheets_manager.sheet is not None
+}
+
+_INDEX_BYTES = orjson.dumps({
+    'service': f'{BUSINESS_NAME} WhatsApp AI Agent',
+    'status': 'active',
+    'endpoints': {
+        'webhook': '/webhook',
+        'health': '/health'
+    }
+})
+
 @app.route('/health')
 def health_check():
     status = {
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
-        'services': {
-            'whatsapp_token': bool(WHATSAPP_TOKEN),
-            'huggingface_token': bool(HUGGINGFACE_TOKEN),
-            'google_sheets': sheets_manager.sheet is not None
-        }
+        'services': _HEALTH_SERVICES
     }
-    return jsonify(status), 200
+    return Response(orjson.dumps(status), mimetype='application/json'), 200
 
 @app.route('/')
 def index():
-    info = {
-        'service': f'{BUSINESS_NAME} WhatsApp AI Agent',
-        'status': 'active',
-        'endpoints': {
-            'webhook': '/webhook',
-            'health': '/health'
-        }
-    }
-    return jsonify(info), 200
+    return Response(_INDEX_BYTES, mimetype='application/json'), 200
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))